@@ -1,8 +1,13 @@
 import os
 import pathlib
 import numpy as np
-import skimage.io
 import rplab_image_analysis.utils.files as files
+from functools import partial
+
+
+#number of pixels counted at a time when building histograms for medians. 
+#np.bincount() makes an intp copy of its input, so this bounds that copy.
+HISTOGRAM_BLOCK_SIZE = 2**22
 
 
 def median_subtract_batch(source_dir: str | pathlib.Path, 
@@ -24,16 +29,36 @@ def median_subtract_batch(source_dir: str | pathlib.Path,
     dest_path = files.get_batch_dest_path(
         source_path, dest_dir, suffix = "_background_subtracted")
     files.shutil_copy_ignore_images(source_path, dest_path)
+    file_paths = []
     for root, directories, filenames in os.walk(source_path):
+        root_path = pathlib.Path(root)
         for filename in filenames:
             if files.get_file_type(filename) in files.ImageFileType:
-                file_path = pathlib.Path(root).joinpath(filename)
-                save_path = files.get_save_path(
-                    file_path, source_path, dest_path, "_bs")
-                median_subtract_image_file(file_path, save_path)
+                file_paths.append(root_path.joinpath(filename))
+    _start_multiprocess(source_path, dest_path, file_paths)
     return str(dest_path)
 
 
+def _start_multiprocess(source_path: pathlib.Path, 
+                        dest_path: pathlib.Path, 
+                        file_paths: list[pathlib.Path]):
+    """
+    Starts multiprocess so that reading, subtracting, and writing of 
+    different files overlap instead of running one file at a time. Each
+    worker only holds one image at a time, so memory use is bounded by the
+    number of workers.
+    """
+    pool_func = partial(_median_subtract_task, source_path, dest_path)
+    files.map_files(pool_func, file_paths)
+
+
+def _median_subtract_task(source_path: pathlib.Path, 
+                          dest_path: pathlib.Path, 
+                          file_path: pathlib.Path):
+    save_path = files.get_save_path(file_path, source_path, dest_path, "_bs")
+    median_subtract_image_file(file_path, save_path)
+
+
 def median_subtract_image_file(file_path: str | pathlib.Path, 
                                save_path: str | pathlib.Path):
     """
@@ -49,18 +74,51 @@ def median_subtract_image_file(file_path: str | pathlib.Path,
         file path that image will be saved to.
     """
     image = files.read_images(file_path)
-    image = get_median_subtracted_image(image)
-    skimage.io.imsave(save_path, image)
+    #image was just read from file, so it's safe to subtract in place.
+    image = get_median_subtracted_image(image, out=image)
+    files.save_image(save_path, image)
 
 
-def get_median_subtracted_image(image: np.ndarray) -> np.ndarray:
+def get_median_subtracted_image(image: np.ndarray, out: np.ndarray = None
+                                ) -> np.ndarray:
     """
     calculates background as median of image/image stack subtracts it
     from image. Returns image with background subtracted as ndarray.
+
+    If out is given, result is written into it (out may be image itself)
+    instead of allocating a new array.
+    """
+    background = _get_median(image)
+    #clipping to background first means subtraction can't go below zero, so
+    #arithmetic stays in the image's native dtype. Casting to int16 would
+    #double memory traffic and overflow for uint16 values above 32767.
+    out = np.maximum(image, background, out=out)
+    return np.subtract(out, background, out=out)
+
+
+def _get_median(image: np.ndarray) -> np.generic:
+    """
+    Returns median of image in image's dtype.
+    """
+    if image.dtype in (np.uint8, np.uint16):
+        return _get_histogram_median(image)
+    return np.median(image).astype(image.dtype)
+
+
+def _get_histogram_median(image: np.ndarray) -> np.generic:
+    """
+    Returns median of uint8 or uint16 image, found from a histogram of its 
+    values. Unlike np.median(), this doesn't partition a full copy of the 
+    image. Same as np.median().astype(), median of an even number of values 
+    is the mean of the two middle values, rounded down.
     """
-    dtype = image.dtype
-    background = int(np.median(image))
-    image = image.astype(np.int16)
-    image -= background
-    image[image < 0] = 0
-    return image.astype(dtype)
+    values = image.ravel()
+    histogram = np.zeros(np.iinfo(image.dtype).max + 1, np.int64)
+    for start in range(0, values.size, HISTOGRAM_BLOCK_SIZE):
+        block = values[start:start + HISTOGRAM_BLOCK_SIZE]
+        histogram += np.bincount(block, minlength=histogram.size)
+    counts = np.cumsum(histogram)
+    #first values whose cumulative counts pass the middle index(es).
+    lower = int(np.searchsorted(counts, (values.size - 1)//2, side="right"))
+    upper = int(np.searchsorted(counts, values.size//2, side="right"))
+    return image.dtype.type((lower + upper)//2)
@@ -1,8 +1,8 @@
 import os
 import pathlib
 import numpy as np
-import skimage.io, skimage.transform
 import rplab_image_analysis.utils.files as files
+from functools import lru_cache, partial
 
 
 def downsample_batch(source_dir: str | pathlib.Path, 
@@ -27,16 +27,37 @@ def downsample_batch(source_dir: str | pathlib.Path,
     dest_path = files.get_batch_dest_path(source_path, dest_dir, 
                                           suffix = "_downsampled")
     files.shutil_copy_ignore_images(source_path, dest_path)
+    file_paths = []
     for root, directories, filenames in os.walk(source_path):
+        root_path = pathlib.Path(root)
         for filename in filenames:
             if files.get_file_type(filename) in files.ImageFileType:
-                file_path = pathlib.Path(root).joinpath(filename)
-                save_path = files.get_save_path(
-                    file_path, source_path, dest_path, "_ds")
-                downsample_image_file(file_path, save_path, downsample_factor)
+                file_paths.append(root_path.joinpath(filename))
+    _start_multiprocess(source_path, dest_path, file_paths, downsample_factor)
     return str(dest_path)
 
 
+def _start_multiprocess(source_path: pathlib.Path, 
+                        dest_path: pathlib.Path, 
+                        file_paths: list[pathlib.Path],
+                        downsample_factor: int):
+    """
+    Starts multiprocess so that files are downsampled in parallel, using 
+    full CPU.
+    """
+    pool_func = partial(
+        _downsample_task, source_path, dest_path, downsample_factor)
+    files.map_files(pool_func, file_paths)
+
+
+def _downsample_task(source_path: pathlib.Path, 
+                     dest_path: pathlib.Path, 
+                     downsample_factor: int,
+                     file_path: pathlib.Path):
+    save_path = files.get_save_path(file_path, source_path, dest_path, "_ds")
+    downsample_image_file(file_path, save_path, downsample_factor)
+
+
 def downsample_image_file(file_path: str | pathlib.Path, 
                           save_path: str | pathlib.Path, 
                           downsample_factor: int):
@@ -56,13 +77,16 @@ def downsample_image_file(file_path: str | pathlib.Path,
     """
     image = files.read_images(file_path)
     image = get_downsampled_image(image, downsample_factor)
-    skimage.io.imsave(save_path, image)
+    files.save_image(save_path, image)
 
 
 def get_downsampled_image(image: np.ndarray, downsample_factor: int
                           ) -> np.ndarray:
     """
     downsamples an single image in (x,y) dimensions by downample_factor. 
+    Each output pixel is the mean of a downsample_factor x downsample_factor
+    block. If height or width isn't a multiple of downsample_factor, the
+    leftover partial block at the edge is cropped off.
     """
     downsample_tuple = _get_downsample_tuple(image.ndim, downsample_factor)
     return _get_downscaled_image(image, downsample_tuple)
@@ -72,26 +96,99 @@ def _get_downscaled_image(image: np.ndarray, downsample_tuple: tuple[int]
                           ) -> np.ndarray:
     """
     downscales given image according to downsample_tuple and returns it as
-    ndarray.
+    ndarray with the same dtype as image.
     """
     dtype = image.dtype
-    image = skimage.transform.downscale_local_mean(image, downsample_tuple)
-    #downscale_local_mean returns float64, so must cast back to original dtype.
-    return image.astype(dtype)
+    block_size = int(np.prod(downsample_tuple))
+    if block_size == 1:
+        return image.copy()
+    crop = tuple(slice(0, dim - dim % factor) 
+                 for dim, factor in zip(image.shape, downsample_tuple))
+    block_sums = image[crop]
+    #box mean is separable, so block sums are computed one axis at a time 
+    #(height before width). This is n + n adds per output pixel instead of
+    #n*n, and each pass works on the already reduced array. Unlike 
+    #downscale_local_mean, this doesn't promote to float64 or make a padded 
+    #copy of the image.
+    sum_dtype = _get_sum_dtype(dtype, block_size)
+    for axis, factor in enumerate(downsample_tuple):
+        if factor > 1:
+            block_sums = _get_axis_block_sums(
+                block_sums, axis, factor, sum_dtype)
+    #block_sums is a new array at this point, so dividing in place is safe.
+    if not np.issubdtype(dtype, np.integer):
+        np.divide(block_sums, block_size, out=block_sums)
+        return block_sums.astype(dtype)
+    if np.issubdtype(dtype, np.signedinteger):
+        #shift and floor division below round toward -inf, but means are 
+        #truncated toward zero like downscale_local_mean(...).astype(). 
+        #Adding block_size - 1 to negative sums makes flooring truncate.
+        np.add(block_sums, block_size - 1, out=block_sums, 
+               where=block_sums < 0)
+    if block_size & (block_size - 1) == 0:
+        #block_size is a power of two (ie, factor 2, 4, 8), so floor 
+        #division is a right shift, which is cheaper than integer division.
+        np.right_shift(
+            block_sums, block_size.bit_length() - 1, out=block_sums)
+    else:
+        np.floor_divide(block_sums, block_size, out=block_sums)
+    return block_sums.astype(dtype)
+
+
+def _get_axis_block_sums(image: np.ndarray, 
+                         axis: int, 
+                         factor: int, 
+                         sum_dtype: type
+                         ) -> np.ndarray:
+    """
+    Returns sums of consecutive blocks of factor elements along axis. Length
+    of image along axis must be a multiple of factor.
+    """
+    #splitting axis into (num_blocks, factor) and summing over factor axis
+    #gives block sums. Splitting a single axis can always be done with 
+    #strides, so reshape returns a view and no copy is made, even when image
+    #is a cropped, non-contiguous view.
+    block_shape = (image.shape[:axis] + (image.shape[axis] // factor, factor) 
+                   + image.shape[axis + 1:])
+    return image.reshape(block_shape).sum(axis=axis + 1, dtype=sum_dtype)
 
 
+def _get_sum_dtype(dtype: np.dtype, block_size: int) -> type:
+    """
+    Returns dtype used to accumulate block sums. For integer images, this is
+    the narrowest integer type that can hold block_size times the largest 
+    value of dtype, so a sum can't overflow regardless of image content. For
+    example, 8 bit images downsampled by up to 16 are summed in 16 bit 
+    integers, and 16 bit images in 32 bit integers. 
+
+    Bounds come from dtype rather than the image's actual max value, so 
+    12 bit camera data stored as uint16 still uses a 32 bit accumulator. 
+    Checking the actual max would cost a full pass over the image, more than
+    the narrower accumulator saves.
+    """
+    if not np.issubdtype(dtype, np.integer):
+        return np.float64
+    if np.issubdtype(dtype, np.unsignedinteger):
+        sum_dtypes = (np.uint16, np.uint32, np.uint64)
+    else:
+        sum_dtypes = (np.int16, np.int32, np.int64)
+    max_sum = int(np.iinfo(dtype).max)*block_size
+    min_sum = int(np.iinfo(dtype).min)*block_size
+    for sum_dtype in sum_dtypes:
+        sum_info = np.iinfo(sum_dtype)
+        if sum_info.min <= min_sum and max_sum <= sum_info.max:
+            return sum_dtype
+    return sum_dtypes[-1]
+
+
+@lru_cache(maxsize=16)
 def _get_downsample_tuple(image_num_dims: int, ds_factor: int) -> tuple[int]:
     """
-    Returns downsample tuple to be used with skimage downsacale_local_mean().
+    Returns downsample tuple with downsample factor of each image dimension.
     Downsample tuple is created so that only dimensions that are downsampled
     are the image height and width.
     """
-    downsample_list = [ds_factor, ds_factor]
-    if image_num_dims > 2:
-        for dim in range(image_num_dims - 2):
-            #width and height are last two dimensions in any Micro-Manager 
-            #image stack, and since we only want to downsample width and 
-            #height, inserting 1 for all the other dimensions ignores them.
-            downsample_list.insert(0, 1)
-    return tuple(downsample_list)
-    
\ No newline at end of file
+    #width and height are last two dimensions in any Micro-Manager image 
+    #stack, and since we only want to downsample width and height, factor
+    #is 1 for all the other dimensions.
+    return (1,)*(image_num_dims - 2) + (ds_factor, ds_factor)
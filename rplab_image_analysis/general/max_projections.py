@@ -1,12 +1,21 @@
 import os
 import pathlib
 import numpy as np
+import psutil
 import skimage.io
+import threading
 import rplab_image_analysis.utils.files as files
-from tifffile import TiffFile
+from functools import partial
+from natsort import natsorted
+from tifffile import COMPRESSION, TiffFile, TiffPage
 
 
-def create_batch_max_projections(source_dir: str | pathlib.Path, 
+#size in bytes of row blocks used in blocked max projection reduction.
+#Chosen to fit comfortably in L2 cache.
+BLOCK_BYTES = 2**18
+
+
+def create_batch_max_projections(source_dir: str | pathlib.Path,
                                  dest_dir: str | pathlib.Path
                                  ) -> str:
     """
@@ -23,7 +32,7 @@ def create_batch_max_projections(source_dir: str | pathlib.Path,
         directory where all images will be saved to.
 
     ### Returns:
-    
+
     dest_path: str
         returns directory where images were written to.
     """
@@ -31,17 +40,21 @@ def create_batch_max_projections(source_dir: str | pathlib.Path,
     dest_path = files.get_batch_dest_path(
         source_path, dest_dir, suffix = "_max_projections")
     files.shutil_copy_ignore_images(source_path, dest_path)
-    dirs = []
+    #os.walk() yields each directory once with all of its filenames, so image
+    #file lists are built here and no directory has to be listed again.
+    file_lists = []
     for root, directories, filenames in os.walk(source_path):
-        for filename in filenames:
-            dirs.append(pathlib.Path(root))
-    for dir in set(dirs):
-        save_path = _get_dir_save_path(dir, source_path, dest_path)
-        create_path_max_projection(dir, save_path)
+        root_path = pathlib.Path(root)
+        file_list = [root_path.joinpath(filename)
+                     for filename in natsorted(filenames)
+                     if files.get_file_type(filename) in files.ImageFileType]
+        if file_list:
+            file_lists.append(file_list)
+    _start_multiprocess(source_path, dest_path, file_lists)
     return str(dest_path)
 
 
-def create_path_max_projection(path: str | pathlib.Path, 
+def create_path_max_projection(path: str | pathlib.Path,
                                save_path: str | pathlib.Path):
     """
     Creates max projection of images located at path and writes it to
@@ -59,10 +72,11 @@ def create_path_max_projection(path: str | pathlib.Path,
         file path that max projection will be saved to.
     """
     max_projection = get_max_projection(path)
-    skimage.io.imsave(save_path, max_projection, check_contrast=False)
+    files.save_image(save_path, max_projection)
 
 
-def get_max_projection(path: str | pathlib.Path) -> np.ndarray:
+def get_max_projection(path: str | pathlib.Path, threads: int | None = None
+                       ) -> np.ndarray:
     """
     Creates max projection of images located at path and returns it as an
     ndarray. If you want the max projection of an ndarray already in Python,
@@ -73,70 +87,165 @@ def get_max_projection(path: str | pathlib.Path) -> np.ndarray:
         only the specified file will be used in the max projection. If path
         is a directory, all image files directly inside directory will be
         used to create max projection.
+
+    threads: int | None = None
+        number of threads compressed pages are decoded on. If None, the 
+        number of physical cores is used. Should be lowered when max 
+        projections are created in several processes or threads at once.
     """
     path = pathlib.Path(path)
     if path.is_file():
-        return _get_single_file_max_projection(path)
+        return _get_single_file_max_projection(path, threads)
     elif path.is_dir():
         file_list = files.get_image_files_in_dir(path)
-        return  _get_multifile_max_projection(file_list)
+        return  _get_multifile_max_projection(file_list, threads)
 
 
 #create_batch_max_projections() helpers
-def _get_dir_save_path(dir, source_path, dest_path):
+def _start_multiprocess(source_path: pathlib.Path,
+                        dest_path: pathlib.Path,
+                        file_lists: list[list[pathlib.Path]]):
     """
-    Returns save path based on first file in dir.
+    Starts multiprocess so that max projections of different directories
+    are created in parallel, using full CPU.
     """
-    file_path = files.get_image_files_in_dir(dir)[0]
-    return files.get_save_path(file_path, source_path, dest_path)
+    #pages are decoded on threads in each worker, so threads are split 
+    #between workers rather than every worker starting one thread per core.
+    pool_func = partial(_max_projection_task, source_path, dest_path, 
+                        threads=files.get_threads_per_worker())
+    files.map_files(pool_func, file_lists)
+
+
+def _max_projection_task(source_path: pathlib.Path,
+                         dest_path: pathlib.Path,
+                         file_list: list[pathlib.Path], 
+                         threads: int | None = None):
+    """
+    Creates max projection of all image files in file_list, which are all
+    image files in a single directory. Save path is based on first file.
+    """
+    save_path = files.get_save_path(file_list[0], source_path, dest_path)
+    max_projection = _get_multifile_max_projection(file_list, threads)
+    files.save_image(save_path, max_projection)
 
 
 #get_max_projection() helpers
-def _get_single_file_max_projection(file_path: str | pathlib.Path):
+def _get_single_file_max_projection(file_path: str | pathlib.Path, 
+                                    threads: int | None = None):
     """
     Returns max_projection created from single image file.
     """
     file_type = files.get_file_type(file_path)
     if file_type == files.ImageFileType.TIF:
-        return _get_tif_max_projection(file_path)
+        return _get_tif_max_projection(file_path, threads)
     elif file_type == files.ImageFileType.PNG:
         return skimage.io.imread(file_path)
-    
 
-def _get_multifile_max_projection(file_list: list[str | pathlib.Path]
+
+def _get_multifile_max_projection(file_list: list[str | pathlib.Path], 
+                                  threads: int | None = None
                                   ) -> np.ndarray:
     """
-    Iterates through files in file_list and creates a single maximum projection 
+    Iterates through files in file_list and creates a single maximum projection
     from all image files.
     """
-    for file_num, file in enumerate(file_list):
-        new_image = _get_single_file_max_projection(file)
-        if file_num == 0:
-            max_projection = new_image
-        max_projection = _get_two_image_max_projection(
-            new_image, max_projection)
+    #next files are read on threads while the current one is added. Files 
+    #read ahead share the thread budget.
+    num_prefetched, file_threads = files.get_prefetch_threads(threads)
+    get_file_max_projection = partial(
+        _get_single_file_max_projection, threads=file_threads)
+    images = files.yield_prefetched(
+        get_file_max_projection, file_list, num_prefetched)
+    max_projection = next(images)
+    for new_image in images:
+        np.maximum(max_projection, new_image, out=max_projection)
     return max_projection
 
 
-def _get_tif_max_projection(file_path: str | pathlib.Path) -> np.ndarray:
+def _get_tif_max_projection(file_path: str | pathlib.Path, 
+                            threads: int | None = None
+                            ) -> np.ndarray:
     """
-    Returns max projection from single tif stack
+    Returns max projection from single tif stack. If image data is
+    uncompressed and contiguous in the file, the stack is memory-mapped so
+    the OS only pages in what the reduction reads. Otherwise, pages are read
+    one at a time.
     """
-    image_stack = TiffFile(file_path)
-    for page_num, page in enumerate(image_stack.pages):
-        new_image = page.asarray()
-        if page_num == 0:
-            max_projection = new_image
-        else:
-            max_projection = _get_two_image_max_projection(
-                new_image, max_projection)
+    max_projection = _get_memmap_max_projection(file_path)
+    if max_projection is None:
+        max_projection = _get_page_max_projection(file_path, threads)
     return max_projection
 
 
-def _get_two_image_max_projection(new_image: np.ndarray, 
-                                  max_projection: np.ndarray
-                                  ) -> np.ndarray:
+def _get_memmap_max_projection(file_path: str | pathlib.Path
+                               ) -> np.ndarray | None:
+    """
+    Returns max projection of memory-mapped tif stack, or None if pages 
+    can't be memory-mapped (ie, they're compressed) or have more than one 
+    sample per pixel (ie, RGB).
+    """
+    with TiffFile(file_path) as stack:
+        first_page = stack.pages[0]
+    if first_page.samplesperpixel > 1:
+        return None
+    image_stack = files.memmap_tif(file_path, mode="r")
+    if image_stack is None:
+        return None
+    #every page in file is mapped, so stack is (pages, height, width).
+    image_stack = image_stack.reshape(-1, *first_page.shape)
+    height, width = image_stack.shape[-2:]
+    max_projection = np.empty((height, width), image_stack.dtype)
+    #reducing a block of rows at a time keeps that block of max_projection
+    #in cache while every page is compared against it, instead of sweeping
+    #the whole output once per page.
+    block_rows = max(1, BLOCK_BYTES // (width*image_stack.itemsize))
+    for start_row in range(0, height, block_rows):
+        rows = slice(start_row, start_row + block_rows)
+        image_stack[:, rows].max(axis=0, out=max_projection[rows])
+    return max_projection
+
+
+def _get_page_max_projection(file_path: str | pathlib.Path, 
+                             threads: int | None = None
+                             ) -> np.ndarray:
+    """
+    Returns max projection of tif stack by reading pages one at a time.
+    """
+    with TiffFile(file_path) as image_stack:
+        #asarray() returns a new array, so first page can be used as the 
+        #output buffer and every other page is maxed into it in place.
+        max_projection = image_stack.pages[0].asarray()
+        for image in _yield_page_images(image_stack, threads):
+            np.maximum(max_projection, image, out=max_projection)
+    return max_projection
+
+
+def _yield_page_images(image_stack: TiffFile, threads: int | None = None):
     """
-    Returns the max projection of new_image and max_projection
+    Yields images of every page in image_stack after the first.
+
+    Uncompressed pages are decoded into a single reused buffer. Compressed
+    pages are CPU-bound to decode, and decompression releases the GIL, so
+    they're decoded ahead in parallel on a number of threads set by threads,
+    or one per physical core if None. At most that many pages are read 
+    ahead of the one being yielded, so memory use doesn't depend on the 
+    number of pages.
     """
-    return np.max(np.array([new_image, max_projection]), 0)
+    first_page = image_stack.pages[0]
+    pages = image_stack.pages[1:]
+    if first_page.compression == COMPRESSION.NONE:
+        page_buffer = np.empty(first_page.shape, first_page.dtype)
+        for page in pages:
+            yield page.asarray(out=page_buffer)
+    else:
+        #pages share one file handle, so seeks and reads must be locked.
+        read_page = partial(_read_page, lock=threading.RLock())
+        if threads is None:
+            threads = psutil.cpu_count(logical=False)
+        yield from files.yield_prefetched(read_page, pages, threads)
+
+
+def _read_page(page: TiffPage, lock: threading.RLock) -> np.ndarray:
+    #maxworkers=1 so tifffile doesn't start its own threads within each
+    #worker thread.
+    return page.asarray(lock=lock, maxworkers=1)
@@ -1,77 +1,198 @@
-import os
 import numpy as np
 import pathlib
 import psutil
-import skimage.io
+import threading
 import utils.files as files
+from collections.abc import Iterable
+from concurrent.futures import ThreadPoolExecutor
 from functools import partial
-from multiprocessing import Pool
-from tifffile import TiffFile
+from itertools import chain
+from tifffile import TiffFile, TiffPage, TiffPages
 from rplab_image_analysis.utils.metadata import MMMetadata
 
 
 PNG = files.ImageFileType.PNG.value[0]
+#max number of pages sampled from a stack to set its 8-bit intensity range.
+LUT_SAMPLE_PAGES = 8
 
 
 def batch_convert_to_pngs(source_dir: str | pathlib.Path, 
-                          dest_dir: str | pathlib.Path
+                          dest_dir: str | pathlib.Path, 
+                          workers: int | None = None, 
+                          to_8bit: bool = False
                           ) -> str:
+    """
+    Converts all tif images in source_dir and all subdirectories in its 
+    structure to PNGs.
+
+    ### Parameters:
+
+    source_dir: str
+        root_dir of images to be converted.
+
+    dest_dir: str
+        destination directory where PNGs will be saved.
+
+    workers: int | None = None
+        number of processes directories are converted in. If None, the number
+        of physical cores is used. Conversion is mostly PNG encoding and disk
+        I/O, so using the number of logical cores, or fewer workers when 
+        images are large enough to limit memory, can be faster.
+
+    to_8bit: bool = False
+        if True, uint16 images are rescaled to uint8 before being saved, which 
+        roughly halves PNG encode time and file size. Intensities are 
+        stretched between the 0.1 and 99.9 percentiles of each tif file, 
+        sampled from up to LUT_SAMPLE_PAGES pages. Images of other dtypes are
+        saved unchanged.
+    """
     source_path = pathlib.Path(source_dir)
     dest_path = files.get_batch_dest_path(source_path, dest_dir, 
                                           suffix = "_pngs")
-    dirs = []
-    for root, directories, filenames in os.walk(source_dir):
-        for filename in filenames:
-            dirs.append(root)
-    dirs = set(dirs)
-    if len(dirs) != 0:
-        files.shutil_copy_ignore_images(source_path, dest_path)
-        _start_multiprocess(source_path, dest_path, dirs)
+    #directory tree is copied in the same walk that finds image dirs, so 
+    #source tree is only walked once.
+    image_dirs = files.yield_image_dirs(source_path, copy_dest_dir=dest_path)
+    #next() checks there's at least one image dir without walking the whole
+    #tree, so workers can start as soon as the first dir is found.
+    first_dir = next(image_dirs, None)
+    if first_dir is not None:
+        _start_multiprocess(
+            source_path, dest_path, chain([first_dir], image_dirs), workers, 
+            to_8bit)
     return str(dest_path)      
 
 
 def _start_multiprocess(source_path: pathlib.Path, 
                         dest_path: pathlib.Path, 
-                        dirs: list[pathlib.Path]):
+                        dirs: Iterable[pathlib.Path], 
+                        workers: int | None = None, 
+                        to_8bit: bool = False):
     """
     Starts multiprocess to utilize full CPU when performing PNG conversion.
     """
-    with Pool(psutil.cpu_count(logical=False)) as pool:
-        pool_func = partial(
-            _png_conversion_task, source_path, dest_path)
-        pool.map(pool_func, dirs)
+    #each worker writes pages on threads, so threads are split between 
+    #workers rather than every worker starting one thread per core.
+    threads = files.get_threads_per_worker(workers)
+    pool_func = partial(_png_conversion_task, source_path, dest_path, 
+                        to_8bit=to_8bit, threads=threads)
+    files.map_files(pool_func, dirs, workers)
 
 
 def _png_conversion_task(source_path: pathlib.Path, 
                          dest_path: pathlib.Path, 
-                         dir: pathlib.Path):
+                         dir: pathlib.Path, 
+                         to_8bit: bool = False, 
+                         threads: int | None = None):
     file_paths = files.get_image_files_in_dir(dir)
     if files.get_file_type(file_paths[0]) == files.ImageFileType.TIF:
-        _tif_png_conversion_task(file_paths, dest_path, source_path)
+        _tif_png_conversion_task(
+            file_paths, dest_path, source_path, to_8bit, threads)
 
 
 def _tif_png_conversion_task(file_paths: list[pathlib.Path], 
                              dest_path: pathlib.Path, 
-                             source_path: pathlib.Path):
+                             source_path: pathlib.Path, 
+                             to_8bit: bool = False, 
+                             threads: int | None = None):
     #keep track of page_num outside of file loop in case there are multiple 
     #tif files in a single directory.
     first_path = file_paths[0]
     page_num = 0
+    metadata = None
     for file_path in file_paths:
-        stack = TiffFile(file_path)
-        is_single_image = _get_stack_num_dims(stack) == 2
-        if is_single_image:
-            save_path = _get_single_save_path(
-                file_path, source_path, dest_path)
-            image = stack.asarray()
-            _write_png(save_path, image)
-        else:
-            for page in stack.pages:
-                save_path = _get_stack_save_path(
-                    first_path, source_path, dest_path, page_num)
-                image = page.asarray()
+        with TiffFile(file_path) as stack:
+            is_single_image = _get_stack_num_dims(stack) == 2
+            if is_single_image:
+                save_path = _get_single_save_path(
+                    file_path, source_path, dest_path)
+                image = stack.asarray()
+                if to_8bit:
+                    image = _apply_lut(image, _get_8bit_lut(image))
                 _write_png(save_path, image)
-                page_num += 1
+            else:
+                #MMMetadata parses the whole metadata file, so it's only 
+                #built once per directory rather than once per page.
+                if metadata is None:
+                    metadata = MMMetadata(first_path)
+                num_pages = len(stack.pages)
+                save_paths = _get_stack_save_paths(
+                    first_path, source_path, dest_path, metadata, 
+                    range(page_num, page_num + num_pages))
+                page_num += num_pages
+                if to_8bit:
+                    lut = _get_8bit_lut(_sample_pages(stack.pages))
+                else:
+                    lut = None
+                _write_page_pngs(save_paths, stack.pages, lut, threads)
+
+
+def _write_page_pngs(save_paths: list[pathlib.Path], 
+                     pages: TiffPages, 
+                     lut: np.ndarray | None = None, 
+                     threads: int | None = None):
+    """
+    Decodes and writes pages to PNGs on a thread pool with threads workers,
+    or one per physical core if threads is None. PNG encoding is CPU-bound 
+    and releases the GIL, so pages are written in parallel. Each thread 
+    decodes its own page and keeps nothing once it's written, so only one 
+    image per thread is held in memory at a time. If lut isn't None, images 
+    are mapped through it before being written.
+    """
+    #pages share one file handle, so seeks and reads must be locked. tifffile
+    #doesn't lock reads of page headers, so all pages are loaded before any 
+    #worker starts reading image data.
+    pages = list(pages)
+    write_page_png = partial(_write_page_png, lut=lut, lock=threading.RLock())
+    if threads is None:
+        threads = psutil.cpu_count(logical=False)
+    with ThreadPoolExecutor(threads) as executor:
+        #list() so exceptions raised in workers aren't silently dropped.
+        list(executor.map(write_page_png, save_paths, pages))
+
+
+def _write_page_png(save_path: pathlib.Path, 
+                    page: TiffPage, 
+                    lut: np.ndarray | None, 
+                    lock: threading.RLock):
+    #maxworkers=1 so tifffile doesn't start its own threads within each 
+    #worker thread.
+    image = page.asarray(lock=lock, maxworkers=1)
+    _write_png(save_path, _apply_lut(image, lut))
+
+
+def _sample_pages(pages: TiffPages) -> np.ndarray:
+    """
+    Returns array of up to LUT_SAMPLE_PAGES evenly spaced pages.
+    """
+    #ceiling division, so at most LUT_SAMPLE_PAGES pages are sampled.
+    step = -(-len(pages) // LUT_SAMPLE_PAGES)
+    return np.stack([page.asarray() for page in pages[::step]])
+
+
+def _get_8bit_lut(sample: np.ndarray) -> np.ndarray | None:
+    """
+    Returns lookup table that maps uint16 values to uint8, stretching 
+    intensities between the 0.1 and 99.9 percentiles of sample. If sample
+    isn't uint16, returns None.
+    """
+    if sample.dtype != np.uint16:
+        return None
+    low, high = np.percentile(sample, [0.1, 99.9])
+    #keeps scale finite for flat images.
+    high = max(high, low + 1)
+    lut = np.arange(np.iinfo(np.uint16).max + 1, dtype=np.float32)
+    lut -= low
+    lut *= 255 / (high - low)
+    np.clip(lut, 0, 255, out=lut)
+    return lut.astype(np.uint8)
+
+
+def _apply_lut(image: np.ndarray, lut: np.ndarray | None) -> np.ndarray:
+    #indexing by the image maps every pixel through the lut without any 
+    #float intermediate the size of the image.
+    if lut is None:
+        return image
+    return lut[image]
 
 
 def _get_stack_num_dims(stack: TiffFile):
@@ -89,8 +210,9 @@ def _get_single_save_path(file_path: pathlib.Path,
 
 def _get_single_image_name(file_path: pathlib.Path) -> str:
     old_name = file_path.name
-    new_name = files.remove_image_extn(old_name)
-    return new_name
+    new_name = files.remove_mmstack(old_name)
+    new_name = files.remove_image_extn(new_name)
+    return f"{new_name}{PNG}"
 
 
 def _get_rel_path(source_path: pathlib.Path, 
@@ -102,27 +224,27 @@ def _get_rel_path(source_path: pathlib.Path,
     return pathlib.Path(str(rel_path).replace(old_name, new_name))
 
 
-def _get_stack_save_path(file_path: pathlib.Path, 
-                         source_path: pathlib.Path, 
-                         dest_path: pathlib.Path, 
-                         page_num: int
-                         ) -> pathlib.Path:
-    new_name = _get_stack_image_name(file_path, page_num)
-    rel_path = _get_rel_path(source_path, file_path, new_name)
-    return dest_path.joinpath(rel_path)
-
-
-def _get_stack_image_name(file_path: pathlib.Path, page_num: int) -> str:
-    name = file_path.name
-    name = files.remove_image_extn(name)
-    metadata = MMMetadata(file_path).get_image_metadata(page_num)
-    coords = metadata.get_coords_str()
-    return f"{name}_{coords}{PNG}"
+def _get_stack_save_paths(file_path: pathlib.Path, 
+                          source_path: pathlib.Path, 
+                          dest_path: pathlib.Path, 
+                          metadata: MMMetadata, 
+                          page_nums: range
+                          ) -> list[pathlib.Path]:
+    """
+    Returns save paths of pages with page_nums in stack at file_path.
+    """
+    #save dir and name are the same for every page, so they're only built 
+    #once rather than once per page.
+    save_dir = dest_path.joinpath(file_path.parent.relative_to(source_path))
+    name = files.remove_image_extn(file_path.name)
+    save_paths = []
+    for page_num in page_nums:
+        coords = metadata.get_image_metadata(page_num).get_coords_str()
+        save_paths.append(save_dir.joinpath(f"{name}_{coords}{PNG}"))
+    return save_paths
 
 
 def _write_png(save_path: pathlib.Path, image: np.ndarray):
     if not save_path.exists():
-        skimage.io.imsave(
-            fname=save_path, arr=image, check_contrast=False, plugin='imageio', 
-            compress_level=3)
+        files.save_image(save_path, image)
     
\ No newline at end of file
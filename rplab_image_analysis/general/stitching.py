@@ -1,18 +1,29 @@
+import contextlib
+import os
 import pathlib
 import numpy as np
-import skimage
-import skimage.io
+import threading
 import tifffile
+from collections.abc import Iterable
+from functools import partial
 
+import rplab_image_analysis.utils.files as files
 import rplab_image_analysis.utils.metadata as metadata
 from rplab_image_analysis.general.max_projections import get_max_projection
 
 
+#size in bytes above which stitched tif images are memory-mapped to disk
+#instead of stitched in memory.
+MEMMAP_STITCH_BYTES = 2**30
+
+
 def stitch_images(file_list: str,
                   save_path: str,
                   x_stage_is_inverted: bool = False,
                   y_stage_is_inverted: bool = False,
-                  num_90_rotations: int = 0):
+                  num_90_rotations: int = 0, 
+                  overwrite: bool = True, 
+                  threads: int | None = None):
     """
     Stitch images together. Currently only works with Micro-Manager images
     with stage positions in metadata.
@@ -42,267 +53,268 @@ def stitch_images(file_list: str,
         number of 90 degree rotations to be applied to images. Relevant
         because xy axes of camera may not line up with xy axes of stage. 
         For Klamath, this should be 0, whereas for Willamette, it should be 3.
+
+    overwrite: bool = True
+        if False and save_path already exists and was modified after every 
+        file in file_list, stitching is skipped. Changes to the other 
+        parameters aren't detected, so leave True when re-stitching the same 
+        files with different settings.
+
+    threads: int | None = None
+        number of threads max projections of files are read on when each file
+        is a separate region. If None, the number of physical cores is used. 
+        Should be lowered when several stitches are run at once.
+
+    Tif stitched images larger than MEMMAP_STITCH_BYTES are stitched 
+    directly into a memory-mapped file so they don't have to fit in RAM. 
+    These are saved uncompressed, since a memory-map needs raw pixel data
+    laid out contiguously in the file. Smaller images are compressed like 
+    any other image saved with files.save_image().
     """
     file_list = [pathlib.Path(file) for file in file_list]
     save_path = pathlib.Path(save_path)
-    if metadata.is_micro_manager(file_list[0]):
-        stitched_image = _stitch_mm_images(
-            file_list, x_stage_is_inverted, y_stage_is_inverted, 
-            num_90_rotations)
-    skimage.io.imsave(save_path, stitched_image, check_contrast=False)
+    if not overwrite and _is_up_to_date(save_path, file_list):
+        return
+    #large tif stitched images are memory-mapped to a file on disk, so they
+    #don't have to fit in RAM or be copied again to be saved. That file is 
+    #only moved to save_path once stitching is done, so a failed stitch 
+    #never leaves a partial image at save_path that looks up to date.
+    if files.get_file_type(save_path) == files.ImageFileType.TIF:
+        memmap_path = save_path.with_name(
+            f"{save_path.stem}_partial{save_path.suffix}")
+    else:
+        memmap_path = None
+    try:
+        #metadata of first file is parsed once here and reused for stitching.
+        first_metadata = metadata.get_mm_metadata(file_list[0])
+        if first_metadata is not None:
+            stitched_image = _stitch_mm_images(
+                file_list, first_metadata, x_stage_is_inverted, 
+                y_stage_is_inverted, num_90_rotations, memmap_path, threads)
+        else:
+            raise ValueError("stitching requires Micro-Manager metadata")
+        if not isinstance(stitched_image, np.memmap):
+            files.save_image(save_path, stitched_image)
+        else:
+            stitched_image.flush()
+            #memory-map has to be closed before file can be moved on Windows.
+            del stitched_image
+            os.replace(memmap_path, save_path)
+    finally:
+        if memmap_path is not None:
+            #file may still be mapped if stitching failed, so it can't always
+            #be removed on Windows.
+            with contextlib.suppress(OSError):
+                memmap_path.unlink(missing_ok=True)
+
+
+def _is_up_to_date(save_path: pathlib.Path, 
+                   file_list: list[pathlib.Path]
+                   ) -> bool:
+    """
+    Returns True if save_path exists and is newer than every file in 
+    file_list.
+    """
+    if not save_path.exists():
+        return False
+    save_mtime = save_path.stat().st_mtime
+    return all(file.stat().st_mtime < save_mtime for file in file_list)
 
 
 def _stitch_mm_images(file_list: list[pathlib.Path], 
+                      first_metadata: metadata.MMMetadata, 
                       x_stage_is_inverted: bool, 
                       y_stage_is_inverted: bool, 
-                      num_90_rotations: int
+                      num_90_rotations: int, 
+                      memmap_path: pathlib.Path | None = None, 
+                      threads: int | None = None
                       ) -> np.ndarray:
     """
-    Stitches images with micro-manager metadata. 
+    Stitches images with micro-manager metadata. If memmap_path isn't None
+    and stitched image is larger than MEMMAP_STITCH_BYTES, it's a tif 
+    memory-map at memmap_path.
     """
     inversion = (x_stage_is_inverted, y_stage_is_inverted)
     if len(file_list) > 1:
-        stitched_image = _stitch_multi_file_mm(file_list, num_90_rotations, inversion)
+        stitched_image = _stitch_multi_file_mm(
+            file_list, first_metadata, num_90_rotations, inversion, 
+            memmap_path, threads)
     else:
-        stitched_image = _stitch_multi_region_mm(file_list[0], num_90_rotations, inversion)
+        stitched_image = _stitch_multi_region_mm(
+            file_list[0], first_metadata, num_90_rotations, inversion, 
+            memmap_path)
     return stitched_image
 
 
-def _stitch_multi_file_mm(file_list, num_90_rotations, inversion):
+def _stitch_multi_file_mm(file_list: list[pathlib.Path], 
+                          first_metadata: metadata.MMMetadata, 
+                          num_90_rotations: int, 
+                          inversion: tuple[bool], 
+                          memmap_path: pathlib.Path | None = None, 
+                          threads: int | None = None
+                          ) -> np.ndarray:
+    """
+    Stitches max projections of files in file_list, where each file is a 
+    separate region. Max projections are read on up to threads threads, or
+    one per physical core if None.
+    """
+    image_metadatas = []
+    image_shapes = []
+    dtypes = []
     for file_num, file_path in enumerate(file_list):
-        new_image = get_max_projection(file_path)
-        image_metadata = metadata.MMMetadata(file_path).get_image_metadata(0)
-        position = _get_position(image_metadata)
         if file_num == 0:
-            start_position = position
-            ds_factor = _get_ds_factor(new_image.shape[-2], image_metadata.image_height)
-            pixel_size = _get_pixel_size(image_metadata.pixel_size, ds_factor)
-            stitched_image = np.rot90(new_image, num_90_rotations)
-            x_offset_range, y_offset_range = _get_start_ranges(stitched_image.shape[-1], stitched_image.shape[-2], num_90_rotations)
+            mm_metadata = first_metadata
         else:
-            new_image = np.rot90(new_image, num_90_rotations)
-            x_offset, y_offset = _get_xy_offsets(
-                start_position, position, inversion, pixel_size)
-            stitched_image = _stitch_new_image(
-                new_image, stitched_image, x_offset, y_offset, 
-                x_offset_range, y_offset_range)
-    return stitched_image
+            mm_metadata = metadata.MMMetadata(file_path)
+        image_metadatas.append(mm_metadata.get_image_metadata(0))
+        #only tif header is read here. Pixel data is read once placement of 
+        #every image is known.
+        with tifffile.TiffFile(file_path) as stack:
+            image_shapes.append(stack.series[0].shape[-2:])
+            dtypes.append(stack.series[0].dtype)
+    #max projections are read ahead on threads, so reading the next image
+    #overlaps with stitching the current one.
+    #prefetched images share the thread budget for decoding compressed pages.
+    num_prefetched, file_threads = files.get_prefetch_threads(threads)
+    get_image = partial(get_max_projection, threads=file_threads)
+    images = files.yield_prefetched(get_image, file_list, num_prefetched)
+    return _stitch_tiles(images, image_shapes, image_metadatas, 
+                         np.result_type(*dtypes), num_90_rotations, inversion, 
+                         memmap_path)
             
 
-def _stitch_multi_region_mm(file, num_90_rotations, inversion):
-    meta = metadata.MMMetadata(file)
-    for page_num, page in enumerate(tifffile.TiffFile(file).pages):
-        new_image = page.asarray()
-        image_metadata = meta.get_image_metadata(page_num)
-        position = _get_position(image_metadata)
-        if page_num == 0:
-            start_position = position
-            ds_factor = _get_ds_factor(new_image.shape[-2], image_metadata.image_height)
-            pixel_size = _get_pixel_size(image_metadata.pixel_size, ds_factor)
-            stitched_image = np.rot90(new_image, num_90_rotations)
-            x_offset_range, y_offset_range = _get_start_ranges(image_metadata)
-        else:
-            new_image = np.rot90(new_image, num_90_rotations)
-            x_offset, y_offset = _get_xy_offsets(
-                start_position, position, inversion, pixel_size)
-            stitched_image = _stitch_new_image(
-                new_image, stitched_image, x_offset, y_offset, 
-                x_offset_range, y_offset_range)
-    return stitched_image
-
-
-def _get_ds_factor(image_height: np.ndarray, meta_height: int) -> int:
+def _stitch_multi_region_mm(file: pathlib.Path, 
+                            meta: metadata.MMMetadata, 
+                            num_90_rotations: int, 
+                            inversion: tuple[bool], 
+                            memmap_path: pathlib.Path | None = None
+                            ) -> np.ndarray:
     """
-    Gets downsample factor to be used in determining correct pixel size of 
-    image.
+    Stitches pages of a single file, where each page is a separate region.
     """
-    return int(meta_height/image_height)
-
-
-def _get_pixel_size(meta_pixel_size: float, ds_factor: float):
-    return meta_pixel_size*ds_factor
-
-
-def _get_position(image_metadata: metadata.MMImageMetadata):
-    return (image_metadata.x_pos, image_metadata.y_pos)
-
-
-def _get_start_ranges(image_width: int, 
-                      image_height: int, 
-                      num_90_rotations: int
-                      ) -> tuple[list[int]]:
+    with tifffile.TiffFile(file) as stack:
+        #every page is loaded up front, since tifffile doesn't lock reads of
+        #page headers and pages are read on prefetch threads below.
+        pages = list(stack.pages)
+        image_metadatas = [meta.get_image_metadata(page_num)
+                           for page_num in range(len(pages))]
+        image_shapes = [page.shape for page in pages]
+        #pages share one file handle, so seeks and reads must be locked.
+        read_page = partial(_read_page, lock=threading.RLock())
+        images = files.yield_prefetched(read_page, pages)
+        return _stitch_tiles(images, image_shapes, image_metadatas,
+                             pages[0].dtype, num_90_rotations, inversion,
+                             memmap_path)
+
+
+def _read_page(page: tifffile.TiffPage, lock: threading.RLock) -> np.ndarray:
+    #maxworkers=1 so tifffile doesn't start its own threads within each 
+    #prefetch thread.
+    return page.asarray(lock=lock, maxworkers=1)
+
+
+def _stitch_tiles(images: Iterable[np.ndarray], 
+                  image_shapes: list[tuple[int]], 
+                  image_metadatas: list[metadata.MMImageMetadata], 
+                  dtype: np.dtype, 
+                  num_90_rotations: int, 
+                  inversion: tuple[bool], 
+                  memmap_path: pathlib.Path | None = None
+                  ) -> np.ndarray:
     """
-    Initializes x and y ranges to be used in dynamic resizing of stitched
-    image.
+    Stitches images into a single stitched image. 
+    
+    Position of every image is determined from image_shapes and metadata 
+    before any image is read, so the stitched image is allocated once at its 
+    final size and each image is placed into it directly. If memmap_path 
+    isn't None and stitched image is larger than MEMMAP_STITCH_BYTES, it's a
+    tif memory-map at memmap_path instead of an array in memory.
     """
-    if num_90_rotations % 2 == 0:
-        stitched_x_range = [0, image_width]
-        stitched_y_range = [0, image_height]
-    else:
-        stitched_x_range = [0, image_width]
-        stitched_y_range = [0, image_height]
-    return stitched_x_range, stitched_y_range
+    offsets = _get_offsets(image_shapes, image_metadatas, inversion)
+    rotated_shapes = [
+        _get_rotated_shape(shape, num_90_rotations) for shape in image_shapes]
+    stitched_image, corners = _init_stitched_image(
+        offsets, rotated_shapes, dtype, memmap_path)
+    for image, (y_start, x_start) in zip(images, corners):
+        image = np.rot90(image, num_90_rotations)
+        region = stitched_image[y_start:y_start + image.shape[0], 
+                                x_start:x_start + image.shape[1]]
+        #If two images are added with the same stage position (ie, if z-stack
+        #is split into two files because it's too large for one), second 
+        #region would just overwrite the first. This takes a max projection 
+        #of the newly added region and the previously added one in place so
+        #this doesn't happen.
+        np.maximum(region, image, out=region)
+    return stitched_image
 
 
-def _get_xy_offsets(start_position: list[int], 
-                    position: list[int], 
-                    inversion: list[bool], 
-                    pixel_size: float
-                    ) -> tuple[int]:
+def _get_offsets(image_shapes: list[tuple[int]], 
+                 image_metadatas: list[metadata.MMImageMetadata], 
+                 inversion: tuple[bool]
+                 ) -> np.ndarray:
     """
-    Returns x and y pixel offets relative to the position of the first image
-    added to the stitched image. 
+    Returns (num_images, 2) array of y and x pixel offsets of every image 
+    relative to the position of the first image.
     """
-    x_offset = _get_pixel_offset(start_position[0], position[0], pixel_size)
-    x_offset *= -1 if inversion[0] else 1
-    y_offset = _get_pixel_offset(start_position[1], position[1], pixel_size)
-    y_offset *= -1 if inversion[1] else 1
-    return x_offset, y_offset
-
-
-def _get_pixel_offset(start_um: float, 
-                      end_um: float, 
-                      pixel_size: float
-                      ) -> int:
+    first_metadata = image_metadatas[0]
+    ds_factor = _get_ds_factor(image_shapes[0][-2], first_metadata.image_height)
+    pixel_size = _get_pixel_size(first_metadata.pixel_size, ds_factor)
+    #positions are (y, x) so offsets line up with numpy (row, column) order.
+    positions = np.array([_get_position(image_metadata)[::-1] 
+                          for image_metadata in image_metadatas])
+    #sign flips stage axes that are inverted relative to the image.
+    signs = np.array([-1 if inversion[1] else 1, -1 if inversion[0] else 1])
+    offsets = np.rint((positions - positions[0])/pixel_size).astype(int)
+    return offsets*signs
+
+
+def _get_rotated_shape(shape: tuple[int], num_90_rotations: int) -> tuple[int]:
     """
-    Calculates pixel offset between images based on difference in 
-    stage positions and returns it.
+    Returns shape of image with shape after np.rot90(image, num_90_rotations).
     """
-    return round((end_um - start_um)/pixel_size)
+    height, width = shape[-2:]
+    if num_90_rotations % 2 == 0:
+        return height, width
+    return width, height
 
 
-def _stitch_new_image(new_image: np.ndarray, 
-                      stitched_image: np.ndarray, 
-                      x_offset: int, 
-                      y_offset: int, 
-                      x_offset_range: list[int], 
-                      y_offset_range: list[int]
-                      ) -> np.ndarray:
+def _init_stitched_image(offsets: np.ndarray, 
+                         shapes: list[tuple[int]], 
+                         dtype: np.dtype, 
+                         memmap_path: pathlib.Path | None = None
+                         ) -> tuple[np.ndarray, list[tuple[int]]]:
     """
-    Stitches new_image with stitched_image based on stage positions in
-    Micro-Manager metadata.
+    Returns array of zeros large enough to fit every image with shape in 
+    shapes at its (y, x) offset in offsets, and (y, x) index of the top left 
+    corner of every image in that array. If memmap_path isn't None and 
+    array is larger than MEMMAP_STITCH_BYTES, it's a tif memory-map created
+    at memmap_path.
     """
-    new_shape = new_image.shape
-    x_extensions, y_extensions = _get_extension_nums(
-        new_shape, x_offset, y_offset, x_offset_range, y_offset_range)
-    x_offset_range, y_offset_range = _update_offset_range(
-        new_shape, x_offset, y_offset, x_offset_range, y_offset_range)
-    stitched_image = _add_stitched_extensions(
-        stitched_image, x_extensions, y_extensions)
-    slices = _get_new_image_slices(
-        new_shape, x_extensions, y_extensions)
-    stitched_image = _place_new_image(stitched_image, new_image, slices)
-    return stitched_image
+    shapes = np.array(shapes)
+    min_offset = offsets.min(axis=0)
+    max_offset = (offsets + shapes).max(axis=0)
+    shape = tuple((max_offset - min_offset).tolist())
+    num_bytes = np.prod(shape, dtype=np.int64)*np.dtype(dtype).itemsize
+    if memmap_path is None or num_bytes <= MEMMAP_STITCH_BYTES:
+        stitched_image = np.zeros(shape, dtype)
+    else:
+        #new tif memory-maps are zero-filled.
+        stitched_image = tifffile.memmap(memmap_path, shape=shape, dtype=dtype)
+    corners = (offsets - min_offset).tolist()
+    return stitched_image, corners
 
 
-def _add_stitched_extensions(stitched_image: np.ndarray, 
-                             x_extensions: list[int], 
-                             y_extensions: list[int]
-                             ) -> np.ndarray:
-    """
-    Concatenates image extensions and stitched image. Image extensions
-    are arrays of zeros that are added to the left, right, top, and bottom
-    of stitched_image to make space for newly added new_image.
+def _get_ds_factor(image_height: np.ndarray, meta_height: int) -> int:
     """
-    dtype = stitched_image.dtype
-    if x_extensions[0] > 0:
-        left_extension = np.zeros([stitched_image.shape[0], x_extensions[0]])
-        #The axis=1 argument concatentates on along the second (x) axis
-        stitched_image = np.concatenate([left_extension, stitched_image], axis=1)
-    if x_extensions[1] > 0:
-        right_extension = np.zeros([stitched_image.shape[0], x_extensions[1]])
-        stitched_image = np.concatenate([stitched_image, right_extension], axis=1)
-    if y_extensions[0] > 0:
-        top_extension = np.zeros([y_extensions[0], stitched_image.shape[1]])
-        stitched_image = np.concatenate([top_extension, stitched_image])
-    if y_extensions[1] > 0:
-        bot_extension = np.zeros([y_extensions[1], stitched_image.shape[1]])
-        stitched_image = np.concatenate([stitched_image, bot_extension])
-
-    #numpy concatenation doesn't conserve datatype, so ensure
-    #datatype is same as original stitched image.
-    return stitched_image.astype(dtype)
-
-
-def _get_extension_nums(new_shape: tuple[int],
-                        x_offset: int,
-                        y_offset: int,
-                        x_offset_range: list[int],
-                        y_offset_range: list[int]
-                        ) -> tuple[list[int]]:
+    Gets downsample factor to be used in determining correct pixel size of 
+    image.
     """
-    Gets stitched extensions--number of rows and columns to be concatenated
-    to stitched_image--to make room for new_image to be added.
+    return int(meta_height/image_height)
 
-    x_extensions contains left and right extensions and y_extensions has
-    top and bottom extensions.
-    """
-    x_min_extension = x_offset_range[0] - x_offset
-    x_max_extension = (x_offset + new_shape[-2]) - x_offset_range[1]
-    y_min_extension = y_offset_range[0] - y_offset
-    y_max_extension = (y_offset + new_shape[-2]) - y_offset_range[1]
-    x_extensions = [x_min_extension, x_max_extension]
-    y_extensions = [y_min_extension, y_max_extension]
-    return x_extensions, y_extensions
-
-
-def _get_new_image_slices(new_shape: tuple[int], 
-                          x_extensions: list[int], 
-                          y_extensions: list[int],
-                          ) -> tuple[slice]:
-    """
-    Gets image position slices where new_image will be inserted
-    into stitched_image array.
-    """
-    #if extensions were added to left side of image to make room for
-    #new image
-    if x_extensions[0] > 0:
-        x_slice = slice(0, new_shape[-1])
-    #if x_extensions[0] <= 0 then no extensions were added, and so -extensions[0]
-    #is the relativive offset from the left side of the image.
-    else:
-        x_slice = slice(-x_extensions[0], new_shape[-1] - x_extensions[0])
-    #same idea as x except for from the top of the image.
-    if y_extensions[0] > 0:
-        y_slice = slice(0, new_shape[-2])
-    else:
-        y_slice = slice(-y_extensions[0], new_shape[-2] - y_extensions[0])
-    return x_slice, y_slice
-
-
-def _place_new_image(stitched_image: np.ndarray, 
-                     new_image: np.ndarray, 
-                     slices: tuple[slice]
-                     ) -> np.ndarray:
-    #If two images are added with the same stage position (ie, if z-stack 
-    #is split into two files because it's too large for one), second region
-    #would just overwrite the first. This takes a max projection of the
-    #newly added region and the previously added one so this doesn't 
-    #happen.
-    #region of image where new image will be placed
-    stitched_region = stitched_image[slices[1], slices[0]]
-    #array containing both region of stitched image and new image to be added
-    region_array = np.array((stitched_region, new_image))
-    #creates new array with max values between the two arrays
-    new_region = np.max(region_array, 0)
-    #places new region into stitched image.
-    stitched_image[slices[1], slices[0]] = new_region
-    return stitched_image
 
+def _get_pixel_size(meta_pixel_size: float, ds_factor: float):
+    return meta_pixel_size*ds_factor
 
-def _update_offset_range(new_shape: tuple[int],
-                         x_offset: int,
-                         y_offset: int,
-                         x_offset_range: list[int], 
-                         y_offset_range: list[int],
-                         ) -> tuple[list[int]]:
-    """
-    Determines new stitched image range by comparing min and max values of
-    old stitched image range and offsets. If new image is added with offset
-    within these new ranges, extensions will not have to be added.
-    """
-    x_offset_range[0] = min(x_offset_range[0], x_offset)
-    y_offset_range[0] = min(y_offset_range[0], y_offset)
-    x_offset_range[1] = max(x_offset_range[1], x_offset + new_shape[-1])
-    y_offset_range[1] = max(y_offset_range[1], y_offset + new_shape[-2])
-    return x_offset_range, y_offset_range
+
+def _get_position(image_metadata: metadata.MMImageMetadata):
+    return (image_metadata.x_pos, image_metadata.y_pos)
@@ -1,23 +1,49 @@
+import json
 import numpy as np
-from rplab_image_analysis.general.max_projections import create_batch_max_projections
+import pathlib
+import psutil
+import pytest
+import tifffile
+import rplab_image_analysis.general.max_projections as max_projections
+import rplab_image_analysis.general.stitching as stitching
+from rplab_image_analysis.general.max_projections import create_batch_max_projections, get_max_projection
 from rplab_image_analysis.general.downsampling import get_downsampled_image, downsample_batch
 from rplab_image_analysis.general.downsampling import _get_downsample_tuple
 from rplab_image_analysis.general.stitching import stitch_images
 from rplab_image_analysis.general.png_conversion import batch_convert_to_pngs
+from rplab_image_analysis.general.png_conversion import _get_single_image_name
 from rplab_image_analysis.general.background_subtraction import median_subtract_batch
+from rplab_image_analysis.general.background_subtraction import get_median_subtracted_image
 
 
 class TestDownsample(object):
     def test_get_downsample_tuple(self):
-        test_image = np.ones([5, 40, 400, 800])
-        downsample_tuple = _get_downsample_tuple(len(test_image.shape), 4)
+        test_image_shape = (5, 40, 400, 800)
+        downsample_tuple = _get_downsample_tuple(len(test_image_shape), 4)
         assert downsample_tuple == (1, 1, 4, 4)
 
     def test_get_downsampled_image(self):
-        test_image = np.ones([200, 400, 400])
+        #broadcast view of a single value, so no test image is allocated.
+        test_image = np.broadcast_to(np.float64(1.0), (200, 400, 400))
         downsampled_image = get_downsampled_image(test_image, 4)
         assert downsampled_image.shape == (200, 100, 100)
 
+    def test_get_downsampled_image_values(self):
+        test_image = np.arange(36, dtype=np.uint16).reshape(6, 6)
+        downsampled_image = get_downsampled_image(test_image, 4)
+        #partial blocks on the bottom and right edges are cropped off.
+        assert downsampled_image.shape == (1, 1)
+        assert downsampled_image.dtype == np.uint16
+        assert downsampled_image[0, 0] == test_image[:4, :4].mean() // 1
+
+    def test_get_downsampled_image_negative_values(self):
+        #negative means are truncated toward zero, like astype() of a float
+        #mean, for both shift (factor 2) and division (factor 3) paths.
+        test_image = np.array([[-1, -2, -4], [0, -2, -4], [-3, -3, -4]],
+                              dtype=np.int16)
+        assert get_downsampled_image(test_image, 2).tolist() == [[-1]]
+        assert get_downsampled_image(test_image, 3).tolist() == [[-2]]
+
     def test_downsample_batch(self):
         source_dir = r"Z:\21June2023 Overnight\Acquisition\fish1\pos1\zstack\GFP"
         dest_dir = r"Z:\JGTEST\downsample_test"
@@ -25,13 +51,158 @@ class TestDownsample(object):
 
 
 class TestMaxProjections(object):
+    def test_get_max_projection(self, tmp_path):
+        rng = np.random.default_rng(0)
+        stacks = [rng.integers(0, 4096, (5, 32, 48), dtype=np.uint16) 
+                  for i in range(2)]
+        for stack_num, stack in enumerate(stacks):
+            tifffile.imwrite(tmp_path.joinpath(f"stack_{stack_num}.tif"), stack)
+        max_projection = get_max_projection(tmp_path)
+        assert max_projection.dtype == np.uint16
+        assert np.array_equal(max_projection, np.max(stacks, axis=(0, 1)))
+
+    def test_get_max_projection_multi_series(self, tmp_path):
+        file_path = tmp_path.joinpath("two_series.ome.tif")
+        first_series = np.arange(100, dtype=np.uint16).reshape(1, 10, 10)
+        with tifffile.TiffWriter(file_path, ome=True) as writer:
+            writer.write(first_series)
+            writer.write(first_series + 100)
+        #every page in file is projected, not just the first series.
+        assert get_max_projection(file_path).max() == 199
+
+    def test_get_max_projection_rgb(self, tmp_path):
+        file_path = tmp_path.joinpath("rgb.tif")
+        rng = np.random.default_rng(0)
+        stack = rng.integers(0, 256, (2, 40, 50, 3), dtype=np.uint8)
+        tifffile.imwrite(file_path, stack, photometric="rgb")
+        max_projection = get_max_projection(file_path)
+        assert max_projection.shape == (40, 50, 3)
+        assert np.array_equal(max_projection, stack.max(axis=0))
+
+    def test_get_multifile_max_projection_threads(self, monkeypatch):
+        monkeypatch.setattr(psutil, "cpu_count", lambda logical=True: 16)
+        file_threads = []
+        def get_file_max_projection(file_path, threads=None):
+            file_threads.append(threads)
+            return np.zeros((2, 2), np.uint16)
+        monkeypatch.setattr(max_projections, "_get_single_file_max_projection",
+                            get_file_max_projection)
+        file_list = ["a.tif", "b.tif", "c.tif"]
+        #prefetched files split the caller's budget, not the core count.
+        max_projections._get_multifile_max_projection(file_list, threads=1)
+        assert file_threads == [1, 1, 1]
+        file_threads.clear()
+        max_projections._get_multifile_max_projection(file_list, threads=None)
+        assert file_threads == [8, 8, 8]
+
     def test_create_batch_max_projections(self):
         source_dir = r"Z:\21June2023 Overnight\Acquisition\fish1\pos1\zstack\GFP\timepoint1"
         dest_dir = r"Z:\JGTEST\max_projection_test"
         create_batch_max_projections(source_dir, dest_dir)
 
 
+def _write_mm_file(file_path, stack, positions):
+    """
+    Writes stack to file_path with a Micro-Manager style metadata file, where
+    positions are the (x, y) stage positions in microns of each page.
+    """
+    tifffile.imwrite(file_path, stack, photometric="minisblack")
+    height, width = stack.shape[-2:]
+    metadata = {"Summary": {}}
+    for page_num, (x_pos, y_pos) in enumerate(positions):
+        metadata[f"FrameKey-{page_num}-0-0"] = {
+            "PixelSizeUm": 1.0, "Binning": 1, "ROI": f"0-0-{width}-{height}",
+            "XPositionUm": x_pos, "YPositionUm": y_pos, "ZPositionUm": 0}
+    name = file_path.name.split(".")[0]
+    with open(file_path.parent.joinpath(f"{name}_metadata.txt"), "w") as file:
+        json.dump(metadata, file)
+
+
 class TestStitching(object):
+    #2x3 tiles with distinct values, at (x, y) stage positions that don't 
+    #overlap once tiles are rotated to 3x2.
+    TILES = [np.arange(1, 7, dtype=np.uint16).reshape(2, 3) + 10*tile_num 
+             for tile_num in range(3)]
+    POSITIONS = [(0, 0), (2, 0), (0, 3)]
+    #x stage is inverted, so second tile is left of first tile. Each tile is
+    #rotated by 90 degrees.
+    STITCHED = [[13, 16, 3, 6], 
+                [12, 15, 2, 5], 
+                [11, 14, 1, 4], 
+                [0, 0, 23, 26], 
+                [0, 0, 22, 25], 
+                [0, 0, 21, 24]]
+
+    def test_stitch_images_multi_file(self, tmp_path):
+        paths = []
+        for tile_num, (tile, position) in enumerate(
+                zip(self.TILES, self.POSITIONS)):
+            tile_dir = tmp_path.joinpath(f"pos{tile_num}")
+            tile_dir.mkdir()
+            paths.append(tile_dir.joinpath("tile_MMStack.ome.tif"))
+            #each file is a z-stack, so its max projection is stitched.
+            _write_mm_file(paths[-1], np.stack([tile - 1, tile]), 
+                           [position]*2)
+        save_path = tmp_path.joinpath("stitched.tif")
+        stitch_images(paths, save_path, num_90_rotations=1, 
+                      x_stage_is_inverted=True)
+        assert tifffile.imread(save_path).tolist() == self.STITCHED
+
+    def test_stitch_images_threads(self, tmp_path, monkeypatch):
+        monkeypatch.setattr(psutil, "cpu_count", lambda logical=True: 16)
+        file_threads = []
+        def get_tile_max_projection(path, threads=None):
+            file_threads.append(threads)
+            return get_max_projection(path)
+        monkeypatch.setattr(stitching, "get_max_projection", 
+                            get_tile_max_projection)
+        paths = []
+        for tile_num, (tile, position) in enumerate(
+                zip(self.TILES, self.POSITIONS)):
+            paths.append(tmp_path.joinpath(f"pos{tile_num}", "tile.tif"))
+            paths[-1].parent.mkdir()
+            _write_mm_file(paths[-1], tile[np.newaxis], [position])
+        save_path = tmp_path.joinpath("stitched.tif")
+        #prefetched tiles split the caller's budget, not the core count.
+        stitch_images(paths, save_path, threads=1)
+        assert file_threads == [1, 1, 1]
+        file_threads.clear()
+        stitch_images(paths, save_path)
+        assert file_threads == [8, 8, 8]
+
+    def test_stitch_images_multi_region(self, tmp_path):
+        file_path = tmp_path.joinpath("regions_MMStack.ome.tif")
+        _write_mm_file(file_path, np.stack(self.TILES), self.POSITIONS)
+        save_path = tmp_path.joinpath("stitched.tif")
+        stitch_images([file_path], save_path, num_90_rotations=1, 
+                      x_stage_is_inverted=True)
+        assert tifffile.imread(save_path).tolist() == self.STITCHED
+
+    def test_stitch_images_compression(self, tmp_path, monkeypatch):
+        file_path = tmp_path.joinpath("regions_MMStack.ome.tif")
+        _write_mm_file(file_path, np.stack(self.TILES), self.POSITIONS)
+        save_path = tmp_path.joinpath("stitched.tif")
+        stitch_images([file_path], save_path, num_90_rotations=1, 
+                      x_stage_is_inverted=True)
+        with tifffile.TiffFile(save_path) as stack:
+            assert stack.pages[0].compression != tifffile.COMPRESSION.NONE
+        #images over the size threshold are memory-mapped, so uncompressed.
+        monkeypatch.setattr(stitching, "MEMMAP_STITCH_BYTES", 0)
+        stitch_images([file_path], save_path, num_90_rotations=1, 
+                      x_stage_is_inverted=True)
+        with tifffile.TiffFile(save_path) as stack:
+            assert stack.pages[0].compression == tifffile.COMPRESSION.NONE
+            assert stack.asarray().tolist() == self.STITCHED
+        assert list(tmp_path.glob("*_partial*")) == []
+
+    def test_stitch_images_no_metadata(self, tmp_path):
+        file_path = tmp_path.joinpath("tile.tif")
+        tifffile.imwrite(file_path, self.TILES[0])
+        save_path = tmp_path.joinpath("stitched.tif")
+        with pytest.raises(ValueError):
+            stitch_images([file_path], save_path)
+        assert not save_path.exists()
+
     def test_stitch_images(self):
         base_dir = r"Z:\25Sept2023 Fixed Fish\GF\Fish 2\Acquisition\fish1\pos1\zstack\gfp\timepoint1\fish1_pos1_zstack_GFP_timepoint1_MMStack.ome.tif"
         pos_nums = [1,2,3,4]
@@ -43,6 +214,12 @@ class TestStitching(object):
 
 
 class TestPngConversion(object):
+    def test_get_single_image_name(self):
+        file_path = pathlib.Path("fish1/image.tif")
+        assert _get_single_image_name(file_path) == "image.png"
+        file_path = pathlib.Path("fish1/fish1_MMStack.ome.tif")
+        assert _get_single_image_name(file_path) == "fish1.ome.png"
+
     def test_batch_convert_to_pngs(self):
         source_dir = r"Z:\21June2023 Overnight\Acquisition\fish1\pos1\zstack\GFP"
         dest_dir = r"Z:\JGTEST\png_conversion_test"
@@ -50,6 +227,18 @@ class TestPngConversion(object):
 
 
 class TestBackgroundSubtraction(object):
+    def test_get_median_subtracted_image(self):
+        test_image = np.array([[1, 5, 40000], [3, 3, 2]], dtype=np.uint16)
+        subtracted_image = get_median_subtracted_image(test_image)
+        assert subtracted_image.dtype == np.uint16
+        assert subtracted_image.tolist() == [[0, 2, 39997], [0, 0, 0]]
+
+    def test_get_median_subtracted_image_even_median(self):
+        #median of 4 and 7 is 5.5, which is rounded down like np.median()
+        test_image = np.array([[1, 4, 9], [7, 8, 2]], dtype=np.uint16)
+        subtracted_image = get_median_subtracted_image(test_image)
+        assert subtracted_image.tolist() == [[0, 0, 4], [2, 3, 0]]
+
     def test_background_subtract_batch(self):
         source_dir = r"Z:\21June2023 Overnight\Acquisition\fish1\pos1\zstack\GFP\timepoint1"
         dest_dir = r"Z:\JGTEST\background_subtract_test"
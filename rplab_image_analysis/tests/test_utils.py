@@ -1,3 +1,6 @@
+import pathlib
+import psutil
+from utils.files import get_prefetch_threads, remove_image_extn
 from utils.metadata import MMMetadata
 
 class TestMMMetadata(object):
@@ -15,3 +18,19 @@ class TestMMMetadata(object):
             shape.append(dims[key])
         shape = tuple(shape)
         print(shape)
+
+
+class TestFiles(object):
+    def test_remove_image_extn(self):
+        assert remove_image_extn("fish1_MMStack.ome.tif") == "fish1_MMStack.ome"
+        assert remove_image_extn("notes.txt") == "notes.txt"
+        #only the final extension is removed, not matching text elsewhere.
+        assert remove_image_extn("scan.tif_files/a.tif") == "scan.tif_files/a"
+        file_path = pathlib.Path("scan.tif_files/a.tiff")
+        assert remove_image_extn(file_path) == pathlib.Path("scan.tif_files/a")
+
+    def test_get_prefetch_threads(self, monkeypatch):
+        monkeypatch.setattr(psutil, "cpu_count", lambda logical=True: 16)
+        assert get_prefetch_threads() == (2, 8)
+        assert get_prefetch_threads(5) == (2, 2)
+        assert get_prefetch_threads(1) == (1, 1)
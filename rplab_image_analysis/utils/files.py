@@ -14,14 +14,29 @@ to strings using str() or vice versa with pathlib.Path().
 
 
 import contextlib
+import imageio.v3
+import os
 import pathlib
 import shutil
 import psutil
 import numpy as np
 import skimage.io
+from collections import deque
+from collections.abc import Callable, Iterable, Iterator
+from concurrent.futures import ThreadPoolExecutor
 from enum import Enum
-from natsort import natsorted
-from tifffile import TiffFile
+from multiprocessing import Pool
+from natsort import natsort_keygen
+from tifffile import TiffFile, imwrite
+
+
+#default number of items read ahead by yield_prefetched().
+NUM_PREFETCHED = 2
+#natural sort key, built once rather than on every natsorted() call.
+_NATSORT_KEY = natsort_keygen()
+#zlib level of saved PNGs. Level 3 encodes several times faster than the 
+#default of 6, for files only slightly larger.
+PNG_COMPRESS_LEVEL = 3
 
 
 class ImageFileType(Enum):
@@ -38,10 +53,24 @@ class ImageFileType(Enum):
     PNG: str = [".png"]
 
 
+#set of all image file extensions, for fast membership checks on every file
+#in directory walks.
+IMAGE_EXTNS = frozenset(
+    extn for file_type in ImageFileType for extn in file_type.value)
+
+
 class OtherFileType(Enum):
     TXT: str = ".txt"
 
 
+#maps every known file extension to its file type, so get_file_type() is a 
+#single lookup.
+_EXTN_TO_TYPE = {
+    extn: file_type for file_type in ImageFileType for extn in file_type.value}
+_EXTN_TO_TYPE.update(
+    {file_type.value: file_type for file_type in OtherFileType})
+
+
 class FileSubtype(Enum):
     """
     Enum class with constants representing file subtype, which is determined
@@ -68,15 +97,7 @@ def get_file_type(file_path: str | pathlib.Path) -> ImageFileType:
     file_type: FileType
         file type of file at file_path.
     """
-    file_extn = get_file_extn(file_path)
-    if file_extn == OtherFileType.TXT.value:
-        return OtherFileType.TXT
-    for extn in ImageFileType.TIF.value:  
-        if file_extn == extn:
-            return ImageFileType.TIF
-    for extn in ImageFileType.PNG.value:  
-        if file_extn == extn:
-            return ImageFileType.PNG
+    return _EXTN_TO_TYPE.get(get_file_extn(file_path))
 
 
 def get_file_subtype(file_path: str | pathlib.Path) -> FileSubtype:
@@ -117,9 +138,11 @@ def get_image_extns() -> list:
 
 def remove_image_extn(file_path) -> str | pathlib.Path:
     file_name = str(file_path)
-    for extn in get_image_extns():
-        if file_name.endswith(extn):
-            file_name = file_name.replace(extn, "")
+    #only the last suffix is removed. Replacing every occurrence of the 
+    #extension would also change directories like "foo.tif_files/".
+    extn = get_file_extn(file_name)
+    if extn in IMAGE_EXTNS:
+        file_name = file_name[:-len(extn)]
     if isinstance(file_path, str):
         return file_name
     elif isinstance(file_path, pathlib.Path):
@@ -163,21 +186,39 @@ def shutil_copy_ignore_images(root_dir: str | pathlib.Path, dest_dir: str | path
         root_dir, dest_dir, ignore=ignore_pattern, dirs_exist_ok=True)
 
 
-def file_in_use(file_path: str | pathlib.Path) -> bool:
+def file_in_use(file_path: str | pathlib.Path, 
+                open_file_paths: set[str] | None = None
+                ) -> bool:
     """
     Checks to see if file located at file_path is currently in use by process
     listed in psutil.processess_iter(). If file is in use, returns True. 
     Else, False.
+
+    ### Parameters:
+
+    file_path: str | pathlib.Path
+
+    open_file_paths: set[str] | None = None
+        snapshot of open file paths from get_open_file_paths(). Scanning 
+        every process is slow, so when checking many files, take one 
+        snapshot and pass it to each call. If None, a new snapshot is taken.
     """
-    file_path = str(file_path)
-    for process in psutil.process_iter():
-        try:
-            for item in process.open_files():
-                if file_path == item.path:
-                    return True
-        except Exception:
-            pass
-    return False
+    if open_file_paths is None:
+        open_file_paths = get_open_file_paths()
+    return str(file_path) in open_file_paths
+
+
+def get_open_file_paths() -> set[str]:
+    """
+    Returns set of paths of all files currently opened by processes listed in
+    psutil.process_iter().
+    """
+    open_file_paths = set()
+    #open_files is None for processes that can't be accessed.
+    for process in psutil.process_iter(["open_files"]):
+        open_files = process.info["open_files"] or []
+        open_file_paths.update(item.path for item in open_files)
+    return open_file_paths
 
 
 def get_dir_name(dir: str | pathlib.Path) -> str:
@@ -235,38 +276,98 @@ def is_other_image_files(file_path: str | pathlib.Path) -> bool:
     """
     file_path = pathlib.Path(file_path)
     for file in file_path.parent.iterdir():
-        is_file_path = file_path.samefile(file)
-        if get_file_type(file) in ImageFileType and not is_file_path:
+        #names are compared instead of using samefile(), which stats both 
+        #files for every file in the directory.
+        if file.name != file_path.name and file.suffix in IMAGE_EXTNS:
             return True
     return False
 
 
-def get_image_files_in_dir(dir: str | pathlib.Path) -> list[str | pathlib.Path]:
+def get_image_files_in_dir(dir: str | pathlib.Path, sort: bool = True
+                           ) -> list[str | pathlib.Path]:
     """
     Returns list of all image files (according to image file types in
     ImageFileType class) in given directory.
+
+    If sort is True, files are naturally sorted. ie, if there are 20 files 
+    named "image_1", "image_2", ..., order is "image_1", "image_2", ... 
+    "image_19" instead of "image_1", "image_10", "image_11", ... "image_2", 
+    "image_3", ... Callers that don't depend on order can skip sorting with 
+    sort=False.
     """
     dir_path = pathlib.Path(dir)
-    files = []
-    for file in dir_path.iterdir():
-        with contextlib.suppress(TypeError):
-            if get_file_type(file) in ImageFileType:
-                files.append(str(file))
-    #natsorted() sorts list so that files are sorted by number subscripts in
-    #the correct order. ie, if there are 20 files named "image_1", "image_2",
-    #..., order is "image_1", "image_2", ... "image_19" instead of "image_1",
-    #"image_10", "image_11", ... "image_2", "image_3", ...
-    files = natsorted(files)
+    files = [str(file) for file in dir_path.iterdir() 
+             if file.suffix in IMAGE_EXTNS]
+    if sort:
+        files.sort(key=_NATSORT_KEY)
     if isinstance(dir, pathlib.Path):
         files = [pathlib.Path(file) for file in files]
     return files
 
 
+def yield_image_dirs(root_dir: str | pathlib.Path, 
+                     copy_dest_dir: str | pathlib.Path | None = None
+                     ) -> Iterator[pathlib.Path]:
+    """
+    Yields path of every directory in the tree of root_dir (including root_dir)
+    that contains at least one image file (according to image file types in 
+    ImageFileType class). 
+    
+    Directories are yielded as the tree is walked, so batch processes can 
+    start working on the first directories before the whole tree is listed.
+
+    ### Parameters:
+
+    root_dir: str
+        root directory that is walked.
+
+    copy_dest_dir: str | None = None
+        if not None, the directory tree of root_dir and all files other than 
+        image files are copied to copy_dest_dir during the same walk, like 
+        shutil_copy_ignore_images(). Each directory is created in 
+        copy_dest_dir before it's yielded.
+    """
+    if copy_dest_dir is not None:
+        #resolved so copy_dest_dir is found whether or not it's given in the
+        #same (relative or absolute) form as root_dir.
+        resolved_dest_dir = pathlib.Path(copy_dest_dir).resolve()
+    for root, directories, filenames in os.walk(root_dir):
+        if copy_dest_dir is not None:
+            _copy_dir_ignore_images(root_dir, copy_dest_dir, root, filenames)
+            #prevents walking into copy_dest_dir when it's inside root_dir.
+            if pathlib.Path(root).resolve() == resolved_dest_dir.parent:
+                with contextlib.suppress(ValueError):
+                    directories.remove(resolved_dest_dir.name)
+        for filename in filenames:
+            if get_file_extn(filename) in IMAGE_EXTNS:
+                yield pathlib.Path(root)
+                break
+
+
+def _copy_dir_ignore_images(root_dir: str | pathlib.Path, 
+                            dest_dir: str | pathlib.Path, 
+                            dir: str, 
+                            filenames: list[str]):
+    """
+    Creates dir in dest_dir at its path relative to root_dir and copies all
+    non-image files in filenames to it.
+    """
+    dest_path = pathlib.Path(dest_dir).joinpath(
+        pathlib.Path(dir).relative_to(root_dir))
+    dest_path.mkdir(parents=True, exist_ok=True)
+    for filename in filenames:
+        if get_file_extn(filename) not in IMAGE_EXTNS:
+            shutil.copy2(os.path.join(dir, filename), dest_path)
+
+
 def get_file_extn(file_path: str | pathlib.Path) -> str:
     """
-    Returns file extension as string.
+    Returns file extension as string, or "" if file_path has no extension.
     """
-    return f".{str(file_path).split('.')[-1]}"
+    #splitext() works on str and pathlib.Path alike without building a new
+    #pathlib.PurePath, which matters since this is called for every file in 
+    #directory walks.
+    return os.path.splitext(file_path)[1]
 
 
 def read_images(file_path: str | pathlib.Path) -> np.ndarray:
@@ -276,11 +377,150 @@ def read_images(file_path: str | pathlib.Path) -> np.ndarray:
     This is mostly here because tifffile loads in all images from all image 
     files that share metadata, which hogs memory. If file_path is a tif file,
     this loads in only the images stored in that file.
+
+    Uncompressed tif files are returned as a copy-on-write memory-map, so 
+    pages are only read from disk as they're used and writing to the 
+    returned array never changes the file. Other files are read into memory.
     """
     if get_file_type(file_path) == ImageFileType.TIF:
-        stack = TiffFile(file_path)
-        num_pages = len(stack.pages)
-        image = stack.asarray(range(num_pages))
+        image = memmap_tif(file_path)
+        if image is None:
+            with TiffFile(file_path) as stack:
+                num_pages = len(stack.pages)
+                image = stack.asarray(range(num_pages))
     else:
         image = skimage.io.imread(file_path)
     return image
+
+
+def map_files(func: Callable, 
+              items: Iterable, 
+              workers: int | None = None):
+    """
+    Calls func on every item in items in a pool of worker processes, for 
+    batch processes where every file or directory can be processed 
+    independently.
+
+    ### Parameters:
+
+    func: Callable
+        function called on each item. Must be picklable, so it should be a 
+        module-level function or a functools.partial of one.
+
+    items: Iterable
+        items that func is called on, such as file paths. items is consumed
+        lazily, so it can be a generator that's still walking a directory 
+        tree.
+
+    workers: int | None = None
+        number of worker processes. If None, the number of physical cores is 
+        used.
+    """
+    if workers is None:
+        workers = psutil.cpu_count(logical=False)
+    with Pool(workers) as pool:
+        #iterating over results re-raises exceptions from workers.
+        for _ in pool.imap_unordered(func, items):
+            pass
+
+
+def get_threads_per_worker(workers: int | None = None) -> int:
+    """
+    Returns number of threads each of workers can run so that all workers 
+    together don't run more threads than there are physical cores. If 
+    workers is None, it's the number of physical cores, as in map_files().
+    """
+    cores = psutil.cpu_count(logical=False)
+    if workers is None:
+        workers = cores
+    return max(1, cores // workers)
+
+
+def get_prefetch_threads(threads: int | None = None) -> tuple[int, int]:
+    """
+    Returns number of items to prefetch with yield_prefetched() and number 
+    of threads each prefetched item can run, so that together they don't run
+    more than threads threads. If threads is None, it's the number of 
+    physical cores.
+    """
+    if threads is None:
+        threads = psutil.cpu_count(logical=False)
+    num_prefetched = min(NUM_PREFETCHED, threads)
+    return num_prefetched, max(1, threads // num_prefetched)
+
+
+def yield_prefetched(func: Callable, 
+                     items: Iterable, 
+                     num_prefetched: int = NUM_PREFETCHED
+                     ) -> Iterator:
+    """
+    Yields func(item) for every item in items, in order. Up to num_prefetched
+    calls are run ahead on a thread pool, so reading the next files overlaps
+    with processing the current one. At most num_prefetched + 1 results are
+    held in memory at once.
+
+    ### Example:
+    >>> for image in yield_prefetched(read_images, file_paths):
+    >>>     process(image)
+    """
+    with ThreadPoolExecutor(num_prefetched) as executor:
+        futures = deque()
+        for item in items:
+            futures.append(executor.submit(func, item))
+            if len(futures) > num_prefetched:
+                yield futures.popleft().result()
+        while futures:
+            yield futures.popleft().result()
+
+
+def memmap_tif(file_path: str | pathlib.Path, mode: str = "c"
+               ) -> np.memmap | None:
+    """
+    Returns all pages in tif file as a memory-map with the same shape as
+    TiffFile.asarray(range(num_pages)), or None if pages aren't all stored 
+    uncompressed and contiguously in the same shape.
+
+    ### Parameters:
+
+    file_path: str | pathlib.Path
+
+    mode: str = "c"
+        np.memmap mode. Default "c" is copy-on-write, so writing to the
+        returned array never changes the file.
+    """
+    #format specific series (ie, Micro-Manager and OME) can span multiple 
+    #files or only part of one, so they're turned off to map every page in 
+    #this file and nothing else.
+    with TiffFile(file_path, is_ome=False, is_mmstack=False, is_imagej=False,
+                  is_shaped=False) as stack:
+        series = stack.series[0]
+        if series.dataoffset is None or len(series.pages) != len(stack.pages):
+            return None
+        dtype = np.dtype(stack.byteorder + series.dtype.char)
+        return np.memmap(file_path, dtype, mode, series.dataoffset, 
+                         series.shape)
+
+
+def save_image(save_path: str | pathlib.Path, image: np.ndarray):
+    """
+    Saves image to save_path.
+
+    Tif files are written with fast (level 1) zlib compression, using a 
+    horizontal predictor for integer images, which typically halves file 
+    size of microscopy images for little CPU time. Images at least as large
+    as a tile are written in 256x256 tiles so that regions can be read 
+    without decoding whole pages. PNG files are written with zlib level 
+    PNG_COMPRESS_LEVEL. Other image types are saved with imageio defaults.
+    """
+    if get_file_type(save_path) == ImageFileType.TIF:
+        is_tiled = min(image.shape[-2:]) >= 256
+        imwrite(save_path, image, compression="zlib", 
+                compressionargs={"level": 1}, 
+                predictor=np.issubdtype(image.dtype, np.integer),
+                tile=(256, 256) if is_tiled else None)
+    elif get_file_type(save_path) == ImageFileType.PNG:
+        #imageio is called directly rather than through skimage.io.imsave(),
+        #which resolves its plugin and checks image contrast on every call.
+        imageio.v3.imwrite(save_path, image, compress_level=PNG_COMPRESS_LEVEL)
+    else:
+        imageio.v3.imwrite(save_path, image)
@@ -15,7 +15,7 @@ class MMMetadata(object):
         file path of MM tif image.
     """
     def __init__(self, file_path: pathlib.Path):
-        self.file_path = file_path
+        self.file_path = pathlib.Path(file_path)
         self._metadata_dict: dict = self._get_metadata_dict()
         self.summary_metadata: dict = self._metadata_dict["Summary"]
         self.key_frames: list = [key for key in self._metadata_dict if "FrameKey" in key]
@@ -24,23 +24,22 @@ class MMMetadata(object):
         self.directory = str(pathlib.Path(file_path).parent)
 
     def _get_metadata_dict(self) -> dict:
-        parent_file_generator = pathlib.Path(self.file_path).parent.iterdir()
-        for file in parent_file_generator:
+        #directory is listed once and reused by both searches below.
+        metadata_files = [file for file in self.file_path.parent.iterdir()
+                          if get_file_subtype(file) == FileSubtype.METADATA]
+        for file in metadata_files:
             #first, checks if there's a metadata file that matches file name
             if self.file_path.name.split(".")[0] == file.name.split("_metadata")[0]:
-                 if get_file_subtype(file) == FileSubtype.METADATA:
-                     return json.load(open(file))
-        else:
-            #if no match is found, assumes whatever metadata file is in the folder
-            #is the correct one.
-            for file in parent_file_generator:
-                if get_file_subtype(file) == FileSubtype.METADATA:
-                    return json.load(open(file))
+                return _read_json(file)
+        #if no match is found, assumes whatever metadata file is in the folder
+        #is the correct one.
+        if metadata_files:
+            return _read_json(metadata_files[0])
         raise FileNotFoundError("MMMetadata file not found in directory.")
     
     def _get_dimensions(self) -> dict:
-        stack = TiffFile(self.file_path)
-        series = stack.series[0]
+        with TiffFile(self.file_path) as stack:
+            series = stack.series[0]
         #last two parts of shape are the image width and height. We only want 
         #the coords.
         coords = list(series.shape[:-2])
@@ -55,6 +54,11 @@ class MMMetadata(object):
     def get_image_metadata(self, image_num: int):
         return MMImageMetadata(self, image_num)
 
+def _read_json(file_path: pathlib.Path) -> dict:
+    with open(file_path) as file:
+        return json.load(file)
+
+
 class MMImageMetadata(object):
     def __init__(self, mm_metadata: MMMetadata, image_num: int):
         self._mm_metadata = mm_metadata
@@ -150,9 +154,19 @@ class LSPycroMetadata(object):
         return self.get_section_dict(section)
     
 def is_micro_manager(file_path: str | pathlib.Path):
+    return get_mm_metadata(file_path) is not None
+
+
+def get_mm_metadata(file_path: str | pathlib.Path) -> MMMetadata | None:
+    """
+    Returns MMMetadata of file at file_path. If file isn't a Micro-Manager 
+    file, returns None. 
+    
+    Use this instead of is_micro_manager() followed by MMMetadata() to only 
+    parse metadata once.
+    """
     try:
-        MMMetadata(file_path)
-        return True
+        return MMMetadata(file_path)
     except FileNotFoundError:
-        return False
+        return None
     
\ No newline at end of file
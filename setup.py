@@ -7,5 +7,5 @@ setup(
    author='Jonah Sokoloff',
    author_email='jonahs@uoregon.edu',
    packages=find_packages(),
-   install_requires=['wheel', 'numpy', 'scikit-image', 'tifffile', 'psutil', 'natsort']
+   install_requires=['wheel', 'numpy', 'scikit-image', 'imageio', 'tifffile', 'psutil', 'natsort']
 )
\ No newline at end of file